@@ -1,21 +1,32 @@
-import os, sys, inspect
+import os, sys
 import argparse
+import hashlib
+import mmap
+import shutil
 import time
+import queue
+import threading
 import logging as log
-from socket import timeout as TimeoutError
-from socket import error as SocketError
-import http
-from ssl import CertificateError
-
-import urllib
-from urllib.parse import urlparse, urlencode, urlunparse
-from urllib.request import urlopen
+from concurrent.futures import ThreadPoolExecutor
+import socket
+
+from urllib.parse import urlparse, urlencode, urlunparse, quote
+import urllib3
 from imagenet.conf.apikeys import imagenet_username, imagenet_accesskey
 
+# disable Nagle and enlarge the receive window of download sockets. The kernel
+# caps SO_RCVBUF at net.core.rmem_max, so raise that (and txqueuelen on the
+# interface) on high latency links to get the full benefit.
+SOCKET_OPTIONS = urllib3.connection.HTTPConnection.default_socket_options + [
+    (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+    (socket.SOL_SOCKET, socket.SO_RCVBUF, 8 * 1024 * 1024),
+]
+
 # add parent dir to system dir
-CURR_DIR = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+CURR_DIR = os.path.dirname(os.path.abspath(__file__))
 ROOT_DIR = os.path.dirname(CURR_DIR)
-sys.path.insert(0, ROOT_DIR)
+if ROOT_DIR not in sys.path:
+    sys.path.insert(0, ROOT_DIR)
 
 
 class DownloadError(Exception):
@@ -30,13 +41,16 @@ class ImagenetDownloader(object):
                  timeout=10,
                  retry=2,
                  sleep=0.8,
+                 workers=None,
+                 per_host=8,
+                 checksum=False,
                  input_encoding=None,
                  synset_wnids_url=None,
                  synset_maps_url=None,
                  synset_original_url=None,
                  verbose=True,):
 
-        self.path = path
+        self.path = os.fspath(path)
         self._input_encoding = input_encoding
         if synset_wnids_url is None:
             synset_wnids_url = "http://www.image-net.org/api/text/imagenet.synset.obtain_synset_list"
@@ -51,6 +65,35 @@ class ImagenetDownloader(object):
         self.timeout = timeout
         self.retry = retry
         self.sleep = sleep
+        if workers is None:
+            workers = min(32, 4 * (os.cpu_count() or 1))
+        if workers < 1:
+            raise ValueError(f"workers must be at least 1, got {workers}")
+        if per_host < 1:
+            raise ValueError(f"per_host must be at least 1, got {per_host}")
+        self.workers = workers
+        self.per_host = per_host
+        self.checksum = checksum
+        # the output path and the constant part of the synset URL are fixed, only the wnid varies
+        self._tar_tmpl = os.path.join(self.path.replace("%", "%%"), "%s.tar")
+        self._url_fns = {}
+        # a single keep-alive pool shared by every request of this downloader
+        # block=True caps the connections per host at per_host, extra workers wait for a free one
+        self._pool = urllib3.PoolManager(num_pools=4,
+                                         maxsize=self.per_host,
+                                         block=True,
+                                         # redirects are followed whatever the error retry budget is
+                                         retries=urllib3.Retry(total=None,
+                                                               connect=self.retry,
+                                                               read=self.retry,
+                                                               status=self.retry,
+                                                               other=self.retry,
+                                                               redirect=10,
+                                                               backoff_factor=self.sleep,
+                                                               status_forcelist=[500, 502, 503, 504],
+                                                               allowed_methods=["GET"]),
+                                         timeout=self.timeout,
+                                         socket_options=SOCKET_OPTIONS)
 
         self.verbose = verbose
         if self.verbose:
@@ -63,89 +106,261 @@ class ImagenetDownloader(object):
         self.get_wnid_maps()
 
     def get_wnids(self, filename=None, release="latest", src="stanford"):
-        if not self.path:
-            os.mkdir(os.path.join(self.path))
-        else:
-            log.info(f"Appending over to {self.path}. The out path already exists!")
+        # the directory must exist before the workers start writing into it
+        os.makedirs(self.path, exist_ok=True)
 
         if filename is None:
             filename = os.path.join(CURR_DIR, "data", "int", "synset_list.txt")
 
+        wnids = []
         with open(filename, "rb") as f:
-            cnt = 0
-            while True:
-                line = f.readline()
-                cnt += 1
-                if line.strip():
-                    wnid = str(line.decode().strip())
-                    self.get_wnid(wnid=wnid, release=release, src=src)
-                if not line:
-                    break
-
-    def get_wnid(self, wnid, release="latest", src="stanford"):
-
-        params = dict(
-            wnid=wnid,
-            username=imagenet_username,
-            accesskey=imagenet_accesskey,
-            release=release,
-            src=src
-        )
-        filename = os.path.join(self.path, wnid + ".tar")
-
-        if not os.path.isfile(filename):
-            log.info(f"Downloading WNDI '{wnid}'..")
-            url = self.build_url(self._synset_original_url + "?", params_extra=params)
-            content = self.download_wnid(url)
+            if os.fstat(f.fileno()).st_size:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                try:
+                    wnids = [wnid.decode("ascii") for wnid in mm[:].split()]
+                finally:
+                    mm.close()
+
+        # one directory listing up front instead of a stat per WNID
+        existing = {entry.name for entry in os.scandir(self.path) if entry.is_file()}
+
+        pending = queue.Queue()
+        # a duplicate WNID would have two workers writing the same .part file
+        wnids = list(dict.fromkeys(wnids))
+        for wnid in wnids:
+            pending.put(wnid)
+
+        errors = []
+        hashes = []
+        stop = threading.Event()
+        # hashing is CPU bound, keep it off the download threads
+        hash_pool = ThreadPoolExecutor(max_workers=os.cpu_count()) if self.checksum else None
+        workers = [threading.Thread(target=self._download_worker,
+                                    args=(pending, errors, existing, stop, hash_pool, hashes, release, src),
+                                    daemon=True)
+                   for _ in range(min(self.workers, len(wnids)))]
+        try:
+            for worker in workers:
+                worker.start()
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            # workers stop after their current WNID, an unfinished tar stays as .part and is resumed
+            stop.set()
+            if hash_pool is not None:
+                hash_pool.shutdown(wait=False, cancel_futures=True)
+            raise
+        if hash_pool is not None:
+            hash_pool.shutdown(wait=True)
+            for filename, future in hashes:
+                if future.exception() is not None:
+                    log.error(f"Cannot hash '{filename}': {future.exception()}")
+                    errors.append(future.exception())
+        if errors:
+            raise DownloadError(f"{len(errors)} of {len(wnids)} WNIDs failed, first error: {errors[0]}")
+
+    def _download_worker(self, pending, errors, existing, stop, hash_pool=None, hashes=None,
+                         release="latest", src="stanford"):
+        while not stop.is_set():
+            try:
+                wnid = pending.get_nowait()
+            except queue.Empty:
+                return
+            # a checksum is only current if it was written for the tar that was already there
+            hashed = wnid + ".tar" in existing and wnid + ".sha256" in existing
+            try:
+                filename = self.get_wnid(wnid=wnid, release=release, src=src, existing=existing)
+            except Exception as e:
+                log.error(f"Cannot download WNID '{wnid}': {e}")
+                errors.append(e)
+                continue
+            if hash_pool is not None and not hashed:
+                hashes.append((filename, hash_pool.submit(self._sha256_file, filename)))
+
+    @staticmethod
+    def _sha256_file(filename):
+        with open(filename, "rb") as f:
+            digest = hashlib.file_digest(f, "sha256").hexdigest()
+        out_path = os.path.splitext(filename)[0] + ".sha256"
+        with open(out_path + ".part", "w") as f:
+            f.write(f"{digest}  {os.path.basename(filename)}\n")
+        os.rename(out_path + ".part", out_path)
+        return out_path
 
-            with open(filename, "wb") as f:
-                f.write(content)
+    def get_wnid(self, wnid, release="latest", src="stanford", existing=None):
+
+        filename = self._tar_tmpl % wnid
+
+        if existing is not None:
+            exists = wnid + ".tar" in existing
+        else:
+            exists = os.path.isfile(filename)
+
+        if not exists:
+            log.info(f"Downloading WNDI '{wnid}'..")
+            url = self._url_fn(release, src)(quote(wnid))
+            # pick up the tail of a .part file left by an interrupted download
+            self.download_wnid(url, filename + ".part", resume_from=self._file_size(filename + ".part"))
+            os.rename(filename + ".part", filename)
+            self._write_validator(filename + ".part", None)
+            if existing is not None:
+                existing.add(wnid + ".tar")
         else:
             log.info(f"Skipping WNID '{wnid}'. The tar file already exists!")
         return filename
 
-    def download_wnid(self, url):
+    def _url_fn(self, release, src):
+        url_fn = self._url_fns.get((release, src))
+        if url_fn is None:
+            params = dict(
+                username=imagenet_username,
+                accesskey=imagenet_accesskey,
+                release=release,
+                src=src
+            )
+            prefix = self.build_url(self._synset_original_url + "?", params_extra=params)
+            url_fn = (prefix.replace("{", "{{").replace("}", "}}") + "&wnid={}").format
+            self._url_fns[(release, src)] = url_fn
+        return url_fn
+
+    def download_wnid(self, url, out_path, resume_from=0):
+        # connect errors and 5xx responses are retried by the pool's Retry policy, a body cut
+        # off mid-transfer is retried here from where the .part file stopped
         count = 0
         while True:
             try:
-                f = urllib.request.urlopen(url, timeout=self.timeout)
-                if f is None:
-                    raise DownloadError('Cannot open URL' + url)
-                content = f.read()
-                f.close()
-                break
-            except (urllib.error.HTTPError, http.client.HTTPException, CertificateError) as e:
-                count += 1
-                if count > self.retry:
-                    raise DownloadError()
-            except (urllib.error.URLError, TimeoutError, SocketError, IOError) as e:
+                self._download_range(url, out_path, resume_from)
+                return out_path
+            except (urllib3.exceptions.ProtocolError, urllib3.exceptions.ReadTimeoutError) as e:
                 count += 1
                 if count > self.retry:
-                    raise DownloadError()
+                    raise DownloadError(f"Cannot download {url}: {e}")
                 time.sleep(self.sleep)
-        return content
+                resume_from = self._file_size(out_path)
+            except urllib3.exceptions.HTTPError as e:
+                raise DownloadError(f"Cannot download {url}: {e}")
+
+    def _download_range(self, url, out_path, resume_from=0):
+        headers = None
+        if resume_from:
+            headers = {"Range": f"bytes={resume_from}-"}
+            validator = self._read_validator(out_path)
+            if validator:
+                # the server answers 200 with the whole file if the tar changed since the .part began
+                headers["If-Range"] = validator
+        resp = self._pool.request("GET", url, headers=headers, preload_content=False)
+        if resp.status == 416:
+            # "bytes */N" with N == resume_from means the .part file is already complete,
+            # e.g. after a crash between the last write and the rename
+            total = resp.headers.get("Content-Range", "").rpartition("/")[2]
+            resp.drain_conn()
+            resp.release_conn()
+            if total == str(resume_from):
+                return
+            # otherwise the server cannot serve the range, start over from the first byte
+            resp = self._pool.request("GET", url, preload_content=False)
+        elif resp.status == 206 and self._range_start(resp) != resume_from:
+            # appending a range that does not start at the end of the .part file would corrupt it
+            resp.drain_conn()
+            resp.release_conn()
+            resp = self._pool.request("GET", url, preload_content=False)
+        try:
+            if resp.status not in (200, 206):
+                resp.drain_conn()
+                raise DownloadError(f"Cannot open URL {url}: HTTP {resp.status}")
+            if resp.status == 200:
+                # a 200 means the server ignored the range and sends the whole file
+                self._write_validator(out_path, resp.headers.get("ETag") or resp.headers.get("Last-Modified"))
+            self._write_stream(resp.stream(1 << 20), out_path, append=resp.status == 206)
+        finally:
+            resp.release_conn()
+
+    @staticmethod
+    def _range_start(resp):
+        # "bytes <start>-<end>/<total>"
+        try:
+            return int(resp.headers.get("Content-Range", "").split()[1].split("-")[0])
+        except (IndexError, ValueError):
+            return None
 
-    def get_wnid_list(self):
+    @staticmethod
+    def _read_validator(out_path):
+        try:
+            with open(out_path + ".validator") as f:
+                return f.read().strip()
+        except FileNotFoundError:
+            return None
 
-        filename = os.path.join("imagenet", "data", "int", "synset_list.txt")
-        if not os.path.isfile(filename):
-            log.info("Downloading WNID list")
-            response = urlopen(self._synset_wnids_url)
-            with open(filename, 'wb') as f:
-                for line in response:
-                    if line.strip():
-                        f.write(line)
+    @staticmethod
+    def _write_validator(out_path, validator):
+        if validator:
+            with open(out_path + ".validator", "w") as f:
+                f.write(validator)
+        else:
+            try:
+                os.remove(out_path + ".validator")
+            except FileNotFoundError:
+                pass
+
+    @staticmethod
+    def _file_size(path):
+        try:
+            return os.stat(path).st_size
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _write_stream(chunks, out_path, append=False):
+        # the tar is written once, sequentially, and never read back here, so hint the
+        # kernel accordingly and drop its pages from the cache once they are on disk,
+        # the kernel ignores DONTNEED for pages that are still dirty
+        flags = os.O_WRONLY | os.O_CREAT | (os.O_APPEND if append else os.O_TRUNC)
+        fd = os.open(out_path, flags, 0o666)
+        with os.fdopen(fd, "wb", buffering=4 * 1024 * 1024) as f:
+            if hasattr(os, "posix_fadvise"):
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            for chunk in chunks:
+                f.write(chunk)
+            f.flush()
+            if hasattr(os, "posix_fadvise"):
+                os.fdatasync(fd)
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
 
-    def get_wnid_maps(self):
+    def get_wnid_list(self):
+        filename = os.path.join(CURR_DIR, "data", "int", "synset_list.txt")
+        return self._ensure_file(filename, self._synset_wnids_url, "WNID list")
 
-        filename = os.path.join("imagenet", "data", "int", "synset_maps.txt")
-        if not os.path.isfile(filename):
-            log.info("Downloading WNID mapping list...")
-            response = urlopen(self._synset_maps_url)
-            with open(filename, 'wb') as f:
-                for line in response:
-                    if line.strip():
-                        f.write(line)
+    def get_wnid_maps(self):
+        filename = os.path.join(CURR_DIR, "data", "int", "synset_maps.txt")
+        return self._ensure_file(filename, self._synset_maps_url, "WNID mapping list")
+
+    def _ensure_file(self, local_path, url, name):
+        # an empty file is what an interrupted download used to leave behind
+        try:
+            if os.stat(local_path).st_size > 0:
+                return local_path
+        except FileNotFoundError:
+            pass
+
+        log.info(f"Downloading {name}..")
+        # the metadata is plain text and compresses well, unlike the synset tars
+        try:
+            resp = self._pool.request("GET", url,
+                                      headers={"Accept-Encoding": "gzip, deflate"},
+                                      preload_content=False,
+                                      decode_content=True)
+            try:
+                if resp.status != 200:
+                    resp.drain_conn()
+                    raise DownloadError(f"Cannot open URL {url}: HTTP {resp.status}")
+                with open(local_path + ".part", "wb") as f:
+                    shutil.copyfileobj(resp, f, 1 << 20)
+            finally:
+                resp.release_conn()
+        except urllib3.exceptions.HTTPError as e:
+            raise DownloadError(f"Cannot download {url}: {e}")
+        os.rename(local_path + ".part", local_path)
+        return local_path
 
     def build_url(self, url, components=None, params_extra=None):
         (scheme, netloc, path, params, query, fragment) = urlparse(url)
@@ -170,14 +385,20 @@ class ImagenetDownloader(object):
         if params is None:
             return None
         else:
-            return urlencode(dict([(key, self._encode(value))
-                                   for key, value in list(params.items()) if value is not None]))
+            return urlencode({key: self._encode(value)
+                              for key, value in params.items() if value is not None})
 
     def _encode(self, value):
-        if self._input_encoding:
+        if self._input_encoding is not None:
             return str(value, self._input_encoding).encode("utf-8")
-        else:
-            return str(value).encode("utf-8")
+        return str(value).encode("utf-8")
+
+
+def _positive_int(value):
+    value = int(value)
+    if value < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return value
 
 
 def main(**args):
@@ -209,6 +430,21 @@ if __name__ == '__main__':
                    type=float,
                    default=0,
                    help='Sleep after download each image in second')
+    p.add_argument('--workers',
+                   type=_positive_int,
+                   default=None,
+                   help='Number of WNIDs downloaded concurrently, min(32, 4 * CPUs) by default. '
+                        'Workers beyond --per_host wait for a free connection')
+    p.add_argument('--per_host',
+                   type=_positive_int,
+                   default=8,
+                   help='Max open connections per host. Values above ~16 may hit the '
+                        'server rate limits')
+    p.add_argument('--checksum',
+                   '-c',
+                   default=False,
+                   action='store_true',
+                   help='Write a <wnid>.sha256 file next to each downloaded tar')
     p.add_argument('--synset_wnids_url',
                    '-w',
                    type=str,
@@ -236,6 +472,9 @@ if __name__ == '__main__':
          timeout=args.timeout,
          retry=args.retry,
          sleep=args.sleep,
+         workers=args.workers,
+         per_host=args.per_host,
+         checksum=args.checksum,
          synset_wnids_url=args.synset_wnids_url,
          synset_maps_url=args.synset_maps_url,
          synset_original_url=args.synset_original_url,